@@ -1,6 +1,10 @@
 """ Utility functions to convert complex python dependency expressions to a format that is usable in RPM spec files """
-from packaging.version import Version
+from packaging.version import Version, InvalidVersion
 from packaging.markers import Marker
+from packaging.specifiers import Specifier, InvalidSpecifier
+from functools import lru_cache, partial
+from operator import eq, ne, lt, le, gt, ge
+import sys
 import re
 
 _rpm_operator_correspondance = {
@@ -12,50 +16,432 @@ _rpm_operator_correspondance = {
     '>': '>',
 }
 
+# Markers that can be evaluated without :class:`~packaging.markers.Marker`, see :func:`~_compile_leaf`
+_version_markers = {'python_version', 'python_full_version', 'implementation_version'}
+_string_markers = {'os_name', 'sys_platform', 'platform_system', 'platform_machine', 'implementation_name',
+                   'platform_python_implementation'}
+_comparisons = {'==': eq, '!=': ne, '<': lt, '<=': le, '>': gt, '>=': ge}
 
-def _single_marker_to_rpm_condition(marker, templates):
-    """ Helper for :func:`~simplify_marker_to_rpm_condition` that expresses a single-cluse marker as a string
+# Kinds of nodes in flattened markers, see :func:`~_flatten`
+_LEAF, _AND, _OR, _GROUP, _END = range(5)
+
+
+
+@lru_cache(maxsize=256)
+def _split(value):
+    """ Memoized whitespace-split of the value of an `in` marker, e.g. `platform_machine in "x86_64 aarch64"` """
+    return tuple(value.split())
+
+
+@lru_cache(maxsize=1024)
+def _final_version(value):
+    """ Parse the value of an environment marker as a version, once per value
 
     Args:
-        marker (`tuple`): A leaf of :class:`~packaging.markers.Marker`’s `_marker` attribute
-        templates (`dict`): templates for python version and architecture
+        value (`str`): The value of the environment marker
 
     Returns:
-        `str`: The RPM-compatible string representation of the marker
+        :class:`~packaging.version.Version` or `None`: The version, or `None` if the value is not a final release,
+                                                       which specifiers treat specially
+    """
+    try:
+        version = Version(value)
+    except InvalidVersion:
+        return None
+
+    return version if str(version) == version.base_version else None
+
+
+@lru_cache(maxsize=1024)
+def _marker_evaluator(name, operator, version):
+    """ Fallback for :func:`~_compile_leaf`, parsing the single-clause marker once to evaluate it with `packaging` """
+    evaluator = Marker(f'{name} {operator} "{version}"')
+
+    def evaluate(val):
+        return evaluator.evaluate({name: val})
+    return evaluate
+
+
+@lru_cache(maxsize=1024)
+def _compile_leaf(name, operator, version):
+    """ Compile a single-clause marker into a predicate on the value of its environment marker
+
+    Plain comparisons are used wherever they give the same results as PEP 508 evaluation: `in` and `not in`, string
+    equality on string markers, and comparisons of final release versions to valid specifiers on version markers.
+    Other cases, e.g. ordered comparisons to versions with a local segment which PEP 508 compares as strings, fall
+    back to evaluating a :class:`~packaging.markers.Marker`.
+
+    Args:
+        name (`str`): The environment marker name
+        operator (`str`): The comparison operator
+        version (`str`): The value to which the environment marker is compared
+
+    Returns:
+        callable: A function returning whether the marker is true for a given `str` value of the environment marker
+    """
+    if operator == 'in':
+        return version.__contains__
+    elif operator == 'not in':
+        return lambda val: val not in version
+
+    compare = _comparisons.get(operator)
+    if compare is None:
+        return _marker_evaluator(name, operator, version)
+
+    try:
+        pinned = Version(version)
+    except InvalidVersion:
+        if name in _string_markers and compare in {eq, ne}:
+            return version.__eq__ if compare is eq else version.__ne__
+        return _marker_evaluator(name, operator, version)
+
+    if name not in _version_markers:
+        return _marker_evaluator(name, operator, version)
+
+    try:
+        Specifier(operator + version)
+    except InvalidSpecifier:
+        return _marker_evaluator(name, operator, version)
+
+    def predicate(val):
+        parsed = _final_version(val)
+        return compare(parsed, pinned) if parsed is not None else _marker_evaluator(name, operator, version)(val)
+    return predicate
+
+
+@lru_cache(maxsize=1024)
+def _eval_single(name, operator, version, env_key):
+    """ Evaluate a single-clause marker for the possible values of its environment marker, with memoization
+
+    Args:
+        name (`str`): The environment marker name
+        operator (`str`): The comparison operator
+        version (`str`): The value to which the environment marker is compared
+        env_key (`tuple`): The environment marker name and a `tuple` of its possible values
+
+    Returns:
+        `bool` or `None`: `True` or `False` if the marker evaluates the same for all environment values, else `None`
     """
-    operator, version = marker[1].value, marker[2].value
-    if marker[0].value == 'platform_machine':  # arch / uname -m
-        arch_template = templates['python_arch']
-        if operator == '==':
-            return 'with ' + arch_template.format(arch=version)
-        elif operator == '!=':
-            return 'without ' + arch_template.format(arch=version)
-        elif operator == 'in':
-            return f'with ({" or ".join(arch_template.format(arch=arch) for arch in version.split())})'
+    predicate = _compile_leaf(name, operator, version)
+
+    # Stop evaluating as soon as the marker is known to be true for some values and false for others
+    any_true = any_false = False
+    for val in env_key[1]:
+        if predicate(val):
+            any_true = True
         else:
-            raise ValueError(f'Unsupported operator {operator} for platform_machine')
+            any_false = True
+        if any_true and any_false:
+            return None
+
+    return any_true
+
 
-    elif marker[0].value in {'python_full_version', 'python_version', 'implementation_version'}:
-        package = templates['python_abi']
-    elif marker[0].value == 'platform_release':
-        package = 'kernel'
+def _arch_condition(format_arch, operator, version):
+    """ Express a `platform_machine` (arch / uname -m) marker as a RPM condition on the python architecture """
+    if operator == '==':
+        return 'with ' + format_arch(arch=version)
+    elif operator == '!=':
+        return 'without ' + format_arch(arch=version)
+    elif operator == 'in':
+        return ''.join(('with (', ' or '.join(format_arch(arch=arch) for arch in _split(version)), ')'))
     else:
-        raise ValueError(f'Unsupported marker {marker[0].value}')
+        raise ValueError(f'Unsupported operator {operator} for platform_machine')
 
+
+def _versioned_condition(package, operator, version):
+    """ Express a marker on a version as a RPM condition on the version of a package """
     rpm_op = _rpm_operator_correspondance.get(operator)
     if rpm_op is not None:
-        return f'with {package} {rpm_op} {version}'
+        return ''.join(('with ', package, ' ', rpm_op, ' ', version))
     elif operator == '~=':
-        return f'with ({package} >= {version} and {package} < {version}^next)'
+        return ''.join(('with (', package, ' >= ', version, ' and ', package, ' < ', version, '^next)'))
     elif operator == '!=':
-        return f'with ({package} < {version} or {package} > {version})'
+        return ''.join(('with (', package, ' < ', version, ' or ', package, ' > ', version, ')'))
     elif operator == 'in':
-        return f'with ({" or ".join(f"{package} = {each_version}" for each_version in version.split())})'
+        return ''.join(('with (', ' or '.join(package + ' = ' + each_version for each_version in _split(version)), ')'))
     else:
-        raise ValueError(f'Unsupported operator {operator} for dependency marker {marker}')
+        raise ValueError(f'Unsupported operator {operator} for dependency marker on {package} "{version}"')
+
+
+def build_marker_converter(templates):
+    """ Specialize the conversion of single-clause markers to RPM conditions for the given templates
+
+    Converters are built once per distinct templates, and memoize their conversions.
+
+    Args:
+        templates (`dict`): templates to express python version (`python_abi`) and architecture (`python_arch`)
+
+    Returns:
+        callable: A function taking a marker’s environment name, operator and value, returning its RPM condition
+    """
+    return _marker_converter(templates['python_arch'], templates['python_abi'])
+
+
+@lru_cache(maxsize=16)
+def _marker_converter(python_arch, python_abi):
+    """ Helper for :func:`~build_marker_converter`, memoized on the templates’ values """
+    # Conversion of single-clause markers to RPM conditions, by environment marker name
+    handlers = {
+        'platform_machine': partial(_arch_condition, python_arch.format),
+        **dict.fromkeys(_version_markers, partial(_versioned_condition, python_abi)),
+        'platform_release': partial(_versioned_condition, 'kernel'),
+    }
+
+    @lru_cache(maxsize=1024)
+    def convert(name, operator, version):
+        handler = handlers.get(name)
+        if handler is None:
+            raise ValueError(f'Unsupported marker {name}')
+        # Identical conditions recur across many requirements, share their storage
+        return sys.intern(handler(operator, version))
 
+    return convert
 
-def simplify_marker_to_rpm_condition(marker, environments, templates):
+
+def _single_marker_to_rpm_condition(marker, templates):
+    """ Helper for :func:`~simplify_marker_to_rpm_condition` that expresses a single-cluse marker as a string
+
+    Args:
+        marker (`tuple`): A leaf of :class:`~packaging.markers.Marker`’s `_marker` attribute
+        templates (`dict`): templates for python version and architecture
+
+    Returns:
+        `str`: The RPM-compatible string representation of the marker
+    """
+    return build_marker_converter(templates)(marker[0].value, marker[1].value, marker[2].value)
+
+
+def _flatten(markers, node_ids):
+    """ Flatten a :class:`~packaging.markers.Marker`’s `_markers` tree into parallel lists, in depth-first order
+
+    Nested lists are hash-consed: structurally identical lists, even from different markers, get the same canonical
+    integer id in `node_ids`, so that their simplifications can be shared.
+
+    Args:
+        markers (`list`): The nested list of markers
+        node_ids (`dict`): The table of canonical ids by structure, shared by markers whose simplifications are shared
+
+    Returns:
+        `int` and `tuple` of `list`: The canonical id of the marker, and the flattened lists: kinds of nodes (leaves,
+                                     `and`, `or`, and start or end of nested lists), environment marker names, operators
+                                     and values for leaves, and for starts of nested lists the index of their end and
+                                     their canonical id
+    """
+    rows = []
+
+    def visit(items):
+        structure = []
+        for item in items:
+            if type(item) is list:
+                start = len(rows)
+                rows.append(None)
+                node = visit(item)
+                rows[start] = (_GROUP, None, None, None, len(rows), node)
+                rows.append((_END, None, None, None, None, None))
+                structure.append(node)
+            elif type(item) is tuple:
+                leaf = (item[0].value, item[1].value, item[2].value)
+                rows.append((_LEAF, *leaf, None, None))
+                structure.append(leaf)
+            else:
+                rows.append((_AND if item == 'and' else _OR, None, None, None, None, None))
+                structure.append(item)
+        return node_ids.setdefault(tuple(structure), len(node_ids))
+
+    root = visit(markers)
+    return root, tuple(list(column) for column in zip(*rows)) if rows else ([], [], [], [], [], [])
+
+
+class MarkerMemo:
+    """ Cache of simplified (sub-)markers to share across calls of :func:`~simplify_marker_to_rpm_condition`
+
+    Not to be shared across threads.
+
+    Attributes:
+        node_ids (`dict`): The canonical ids of (sub-)markers by structure, see :func:`~_flatten`
+        results_by_env (`dict`): The simplified (sub-)markers by canonical id, for each environments and templates
+    """
+    __slots__ = ('node_ids', 'results_by_env')
+
+    def __init__(self):
+        self.node_ids = {}
+        self.results_by_env = {}
+
+
+class _FrozenEnvironments(dict):
+    """ Possible environments normalized by :func:`~freeze_environments`, not to be modified
+
+    Attributes:
+        key (`tuple`): The sorted environments’ items, to identify the environments in a memo
+    """
+    __slots__ = ('key',)
+
+    def __init__(self, environments):
+        super().__init__(environments)
+        self.key = tuple(sorted(self.items()))
+
+
+def freeze_environments(environments):
+    """ Normalize the possible environments to a mapping of sorted `tuple`s of possible values
+
+    A single `str` value is a single possible value, e.g. a single extra.
+
+    Args:
+        environments (`dict`): the possible environments, see :func:`~simplify_marker_to_rpm_condition`
+
+    Returns:
+        `dict`: The environments, with each value as a `tuple` of `str`
+    """
+    if type(environments) is _FrozenEnvironments:
+        return environments
+    return _FrozenEnvironments({env: (values,) if type(values) is str else tuple(sorted(values))
+                                for env, values in environments.items()})
+
+
+def _simplify_leaf(env, operator, value, environments, convert):
+    """ Helper for :func:`~_simplify_flat` that simplifies a single-clause marker
+
+    Args:
+        env (`str`): The environment marker name
+        operator (`str`): The comparison operator
+        value (`str`): The value to which the environment marker is compared
+        environments (`dict`): the possible environments, see :func:`~freeze_environments`
+        convert (callable): The single-clause marker converter, see :func:`~build_marker_converter`
+
+    Returns:
+        `str` or `bool`: The RPM condition for the marker, or `True` or `False` if the marker can be evaluated
+    """
+    values = environments.get(env, ())
+    if env == 'extra':
+        return value in values
+    elif values:
+        evaluation = _eval_single(env, operator, value, (env, values))
+        if evaluation is not None:
+            return evaluation
+
+    return convert(env, operator, value)
+
+
+class _Frame:
+    """ State of :func:`~_simplify_flat` for a (nested) list of markers, which is rendered into a shared output buffer
+
+    Attributes:
+        mark (`int`): Output length before the list and its separator, to truncate to if the list is always true/false
+        start (`int`): Index in the output of a placeholder, set to an opening parenthesis if several clauses remain
+        clauses (`int`): Number of clauses of the list kept so far
+        clause_start (`int`): Output length at the start of the current clause, to truncate to if it is always false
+        conditions (`int` or `None`): Number of conditions in the current clause, or `None` if it is always false
+        end (`int`): Index of the end of the list in the flattened marker
+        node (`int`): Canonical id of the list
+    """
+    __slots__ = ('mark', 'start', 'clauses', 'clause_start', 'conditions', 'end', 'node')
+
+    def __init__(self, mark, start, end, node):
+        """ Start a list whose output begins at `start`, with an empty first clause """
+        self.mark, self.start, self.end, self.node = mark, start, end, node
+        self.clauses, self.clause_start, self.conditions = 0, start + 1, 0
+
+
+def _simplify_flat(root, flat, environments, convert, results):
+    """ Implementation of :func:`~simplify_marker_to_rpm_condition` on a marker flattened by :func:`~_flatten`
+
+    Nested lists of markers are walked with an explicit stack rather than recursion, simplifying them into disjunctive
+    normal form and writing the output in the same pass to a single buffer, which is truncated whenever part of it
+    turns out to be always true or always false. Markers are simplified lazily, so that the remaining terms of a clause
+    are skipped once one is always false, and the remaining clauses of a list are skipped once one is always true.
+
+    Args:
+        root (`int`): The canonical id of the marker
+        flat (`tuple` of `list`): The flattened marker
+        environments (`dict`): the possible environments, see :func:`~freeze_environments`
+        convert (callable): The single-clause marker converter, see :func:`~build_marker_converter`
+        results (`dict`): Simplified markers by canonical id, for these environments and converter
+
+    Returns:
+        `str` or `bool`: A string representing the remaining conditions from the marker, or `True` or `False`
+    """
+    kinds, names, ops, vals, spans, nodes = flat
+    count = len(kinds)
+
+    # The output starts with the placeholder of the outermost list’s opening parenthesis
+    out = ['']
+    stack = [_Frame(0, 0, count, root)]
+    pos = 0
+    while True:
+        frame = stack[-1]
+        kind = kinds[pos] if pos < count else _END
+        if kind == _AND:
+            pos += 1
+            continue
+        elif kind == _LEAF or kind == _GROUP:
+            if frame.conditions is None:
+                pos = pos + 1 if kind == _LEAF else spans[pos] + 1
+                continue
+
+            mark = len(out)
+            if frame.conditions:
+                out.append(' ')
+            elif frame.clauses:
+                out.append(' or ')
+
+            if kind == _LEAF:
+                simple = _simplify_leaf(names[pos], ops[pos], vals[pos], environments, convert)
+                pos += 1
+            elif nodes[pos] in results:
+                simple = results[nodes[pos]]
+                pos = spans[pos] + 1
+            else:
+                stack.append(_Frame(mark, len(out), spans[pos], nodes[pos]))
+                out.append('')
+                pos += 1
+                continue
+
+            if type(simple) is str:
+                out.append(simple)
+                frame.conditions += 1
+                continue
+            del out[mark:]
+        else:
+            # End of a clause: the whole list is true if the clause is, otherwise keep it unless it is false
+            if frame.conditions == 0:
+                simple = True
+            else:
+                if frame.conditions is not None:
+                    frame.clauses += 1
+                if kind == _OR:
+                    frame.clause_start, frame.conditions = len(out), 0
+                    pos += 1
+                    continue
+                simple = None if frame.clauses else False
+
+            pos = frame.end + 1
+            stack.pop()
+            if simple is not None:
+                del out[frame.mark:]
+            else:
+                # Several clauses are parenthesized, fill in the placeholder
+                if frame.clauses > 1:
+                    out[frame.start] = '('
+                    out.append(')')
+                simple = ''.join(out[frame.start:])
+                out[frame.start:] = [simple]
+            results[frame.node] = simple
+
+            if not stack:
+                return simple
+            frame = stack[-1]
+            if type(simple) is str:
+                frame.conditions += 1
+                continue
+
+        # A marker that is always false makes the clause false, one that is always true does not change it
+        if simple is False:
+            del out[frame.clause_start:]
+            frame.conditions = None
+
+
+def simplify_marker_to_rpm_condition(marker, environments, templates, memo=None):
     """ Express a dependency marker in terms useful for RPM packaging, evaluate clauses in the marker if possible
 
     This should remove markers that are always false in the given environments, identify markers that are always true,
@@ -64,8 +450,11 @@ def simplify_marker_to_rpm_condition(marker, environments, templates):
     Args:
         marker (:class:`~packaging.markers.Marker`): The marker to evaluate
         environments (`dict`): the possible environments, with keys are PEP508 environment markers, values are either
-                               a single value as a string, or an iterable of strings for possible values
+                               a single value as a string, or an iterable of strings for possible values, or as
+                               returned by :func:`~freeze_environments`
        templates (`dict`): templates to express python version (`python_abi`) and architecture (`python_arch`)
+       memo (:class:`~MarkerMemo`): A cache of simplified (sub-)markers to share across calls, e.g. for all
+                                    requirements of a package
 
     Returns:
         `str` or `bool`: A string representing the remaining conditions from the marker, or `True` or `False` if the
@@ -74,41 +463,22 @@ def simplify_marker_to_rpm_condition(marker, environments, templates):
     if marker is None:
         return True
 
+    if memo is None:
+        memo = MarkerMemo()
+
     if isinstance(marker, Marker):
         marker = marker._markers
+    root, flat = _flatten(marker if type(marker) is list else [marker], memo.node_ids)
 
-    if type(marker) is str and marker in {'or', 'and'}:
-        return marker
-
-    elif type(marker) is bool:
-        return marker
-
-    elif type(marker) is tuple:
-        env = marker[0].value
-        if env == 'extra':
-            return marker[2].value in environments.get(env, [])
-        elif not environments.get(env):
-            return _single_marker_to_rpm_condition(marker, templates)
+    environments = freeze_environments(environments)
+    key = (environments.key, templates['python_arch'], templates['python_abi'])
+    results = memo.results_by_env.setdefault(key, {})
 
-        evaluator = Marker(f'{marker[0].value} {marker[1].value} "{marker[2].value}"')
-        if type(environments[env]) is str:
-            evaluations = [evaluator.evaluate(environments)]
-        else:
-            evaluations = [evaluator.evaluate({env: val}) for val in environments[env]]
-
-        return (True if all(evaluations) else False if all(not(ev) for ev in evaluations) else True if env == 'extra'
-                else _single_marker_to_rpm_condition(marker, templates))
+    simple = results.get(root)
+    if simple is not None:
+        return simple
 
-    elif type(marker) is list:
-        simple_markers = [simplify_marker_to_rpm_condition(mk, environments, templates) for mk in marker]
-        # disjunctive normal form: drop nested `True`s, `False`s, promote single-item lists and interpret empty lists
-        splits = [n for n, v in enumerate(marker) if v == 'or']
-        dnf = [[mk for mk in simple_markers[slice(before + 1, last)] if mk != 'and' and mk is not True]
-               for before, last in zip([-1, *splits], [*splits, None])]
-        dnf = [True if not cl else cl[0] if len(cl) == 1 else cl for cl in dnf if not any(ev is False for ev in cl)]
-        return (False if not dnf else True if any(cl is True for cl in dnf)
-                else ' '.join(dnf[0]) if len(dnf) == 1 and type(dnf[0]) is list else dnf[0] if len(dnf) == 1
-                else '(' + ' or '.join(' '.join(mk) if type(mk) is list else mk for mk in dnf) + ')')
+    return _simplify_flat(root, flat, environments, build_marker_converter(templates), results)
 
 
 def python_version_to_rpm_version(verstring):
@@ -123,6 +493,21 @@ def python_version_to_rpm_version(verstring):
     ])
 
 
+def _compatible_release_spec(package, version):
+    """ Format the `~=` version specifier as a pair of RPM version requirements """
+    # Caret forces higher sorting (tilde lower)
+    bits = re.sub(r'(.?[abc][0-9]*)?(.[a-z]+[0-9]*)?$', '', version).split('.')
+    return package + ' >= ' + version, package + ' < ' + '.'.join([*bits[:-2], str(int(bits[-2]) + 1)])
+
+
+_spec_formatters = {
+    **{op: lambda package, version, rpm_op=rpm_op: ''.join((package, ' ', rpm_op, ' ', version))
+       for op, rpm_op in _rpm_operator_correspondance.items()},
+    '~=': _compatible_release_spec,
+    '!=': lambda package, version: ''.join((package, ' < ', version, ' or ', package, ' > ', version)),
+}
+
+
 def specifier_to_rpm_version(package, version):
     """ Compute the version-specified dependency of a package to a RPM version requirement
 
@@ -136,18 +521,16 @@ def specifier_to_rpm_version(package, version):
         `str`: A string representing the package dependency with versions
     """
     rpm_specs = []
+    append, extend = rpm_specs.append, rpm_specs.extend
     for spec in version:
-        version = spec.version.rstrip(".*")
-        rpm_op = _rpm_operator_correspondance.get(spec.operator)
-        if rpm_op is not None:
-            rpm_specs.append(f'{package} {rpm_op} {version}')
-        elif spec.operator == '~=':
-            # Caret forces higher sorting (tilde lower)
-            bits = re.sub(r'(.?[abc][0-9]*)?(.[a-z]+[0-9]*)?$', '', version).split('.')
-            rpm_specs.extend([f'{package} >= {version}',
-                              f'{package} < {".".join([*bits[:-2], str(int(bits[-2]) + 1)])}'])
-        elif spec.operator == '!=':
-            rpm_specs.append(f'{package} < {version} or {package} > {version}')
+        fmt = _spec_formatters.get(spec.operator)
+        if fmt is None:
+            continue
+        out = fmt(package, spec.version.rstrip(".*"))
+        if type(out) is tuple:
+            extend(out)
+        else:
+            append(out)
 
     if rpm_specs:
         return ', '.join(rpm_specs)
@@ -29,6 +29,7 @@ except ImportError:
     import importlib_metadata
 
 from pysrpm.convert import specifier_to_rpm_version, simplify_marker_to_rpm_condition, python_version_to_rpm_version
+from pysrpm.convert import freeze_environments, MarkerMemo
 
 
 class RPMBuildError(Exception):
@@ -59,6 +60,8 @@ class RPM:
             raise FileNotFoundError(str(source))
         self.root = source if source.is_dir() else None
         self.source = source if source.is_file() else None
+        # Simplified dependency markers, see convert_python_req
+        self.simplified_markers = MarkerMemo()
 
 
     @staticmethod
@@ -346,9 +349,10 @@ class RPM:
             `list`: A list of string representations for the package dependency with versions
         """
         rpm_reqs = []
-        environments = {**self.environments, 'extra': extras}
+        environments = freeze_environments({**self.environments, 'extra': extras})
         for req in (Requirement(req) for req in reqs):
-            condition = simplify_marker_to_rpm_condition(req.marker, environments, self.templates)
+            condition = simplify_marker_to_rpm_condition(req.marker, environments, self.templates,
+                                                         memo=self.simplified_markers)
             if condition is False:
                 continue
 
@@ -2,12 +2,14 @@ from packaging.markers import Marker
 from packaging.version import Version
 from packaging.specifiers import SpecifierSet
 from pysrpm.convert import _single_marker_to_rpm_condition, simplify_marker_to_rpm_condition, specifier_to_rpm_version
-from pysrpm.convert import python_version_to_rpm_version
+from pysrpm.convert import python_version_to_rpm_version, _compile_leaf, _eval_single, _flatten, _simplify_flat
+from pysrpm.convert import build_marker_converter, freeze_environments, MarkerMemo
 import pysrpm.rpm
 
 import sys
 import rpm
 import pathlib
+from types import MappingProxyType
 
 TEMPLATES = {
     'python_abi': 'python(abi)',
@@ -32,6 +34,11 @@ def single_marker(text):
 def complex_marker(text, extras=[]):
     return simplify_marker_to_rpm_condition(Marker(text), {**ENVIRONMENT, 'extra': extras}, TEMPLATES)
 
+def flat_marker(text, results=None):
+    root, flat = _flatten(Marker(text)._markers, {})
+    return _simplify_flat(root, flat, freeze_environments(ENVIRONMENT), build_marker_converter(TEMPLATES),
+                          {} if results is None else results)
+
 def version(text):
     return specifier_to_rpm_version('package', SpecifierSet(text))
 
@@ -89,6 +96,20 @@ def test_marker_extras():
     assert complex_marker('extra == "micro" and os_name == "posix"', extras=['micro']) == True
     assert complex_marker('extra == "micro" or platform_machine == "x86-64"', extras=[]) == 'with python(x86-64)'
     assert complex_marker('extra == "micro" or platform_machine == "x86-64"', extras=['micro']) == True
+    assert complex_marker('extra == "micro"', extras='micro') == True
+    assert complex_marker('extra == "micro"', extras='micromamba') == False
+    assert complex_marker('extra == "m"', extras='micro') == False
+
+
+def test_freeze_environments():
+    frozen = freeze_environments({'os_name': ['posix', 'nt'], 'extra': 'micro', 'implementation_name': ('cpython',)})
+    assert frozen == {'os_name': ('nt', 'posix'), 'extra': ('micro',), 'implementation_name': ('cpython',)}
+    assert frozen.key == (('extra', ('micro',)), ('implementation_name', ('cpython',)), ('os_name', ('nt', 'posix')))
+    assert freeze_environments(frozen) is frozen
+    assert freeze_environments({'os_name': {'nt', 'posix'}}).key == freeze_environments({'os_name': ['posix', 'nt']}).key
+    # Read-only views of unsorted lists are not mistaken for frozen environments
+    proxy = MappingProxyType({**ENVIRONMENT, 'os_name': ['posix', 'nt']})
+    assert simplify_marker_to_rpm_condition(Marker('os_name != "java"'), proxy, TEMPLATES, memo=MarkerMemo()) == True
 
 
 def test_complex_marker():
@@ -100,6 +121,92 @@ def test_complex_marker():
     assert complex_marker('os_name == "nt" and platform_machine == "x86-64" or platform_release > "3.4"') == 'with kernel > 3.4'
     assert complex_marker('platform_machine != "x86" and platform_release > "5.14"') == 'without python(x86) with kernel > 5.14'
     assert complex_marker('python_version < "3.4"') == 'with python(abi) < 3.4'
+    assert complex_marker('platform_machine == "x86-64" or os_name == "posix"') == True
+    assert complex_marker('platform_machine == "x86-64" or os_name == "nt" or platform_release > "3.4"') == \
+            '(with python(x86-64) or with kernel > 3.4)'
+
+
+def test_leaf_evaluation():
+    # Compiled predicates must agree with PEP 508 evaluation, including the cases that fall back to Marker
+    cases = {
+        'python_full_version': (['3.8.0', '3.8.1rc1', '3.8.1+local', '3.8.1.post1', '3.9.2'], [
+            '== "3.8.0"', '!= "3.8.1"', '< "3.8.1"', '<= "3.8.1"', '> "3.8.0"', '>= "3.8.1"', '~= "3.8"',
+            '== "3.8.*"', '=== "3.8.0"', 'in "3.8.0 3.9.2"', 'not in "3.9.2"',
+            # Ordered comparisons to local versions are invalid specifiers, compared as strings
+            '< "3.8.1+local"', '<= "3.8.1+local"', '> "3.8.1+local"', '>= "3.8.1+local"', '== "3.8.1+local"',
+        ]),
+        'python_version': (['2.7', '3.8', '3.9', '3.10'], ['< "3.10"', '> "3.8"', '== "3.*"', '~= "3.9"', '>= "3.10a1"',
+                                                            '< "3.8+local"', '>= "3.8+local"', '!= "3.8+local"']),
+        'os_name': (['posix', 'nt'], ['== "posix"', '!= "posix"', 'in "posix java"', 'not in "nt"']),
+        'platform_machine': (['x86_64', 'aarch64', 'x86'], ['== "x86"', '!= "x86"', 'in "x86_64 aarch64"']),
+    }
+    for name, (values, clauses) in cases.items():
+        for clause in clauses:
+            operator, version = clause.split(' "')
+            predicate = _compile_leaf(name, operator, version.rstrip('"'))
+            evaluator = Marker(f'{name} {clause}')
+            for value in values:
+                assert predicate(value) == evaluator.evaluate({name: value}), f'{name} {clause} with {name}={value}'
+
+
+def test_leaf_evaluation_over_environments():
+    assert _eval_single('python_full_version', '<', '3.8.1', ('python_full_version', ('3.8.0', '3.8.1rc1'))) is None
+    assert _eval_single('python_full_version', '<', '3.9', ('python_full_version', ('3.8.0', '3.8.1rc1'))) is True
+    assert _eval_single('python_version', '==', '3.*', ('python_version', ('3.8', '3.10'))) is True
+    assert _eval_single('os_name', 'not in', 'nt java', ('os_name', ('nt',))) is False
+
+
+def test_marker_pruning():
+    # platform_version can not be expressed in RPM conditions, but is never reached
+    assert complex_marker('os_name == "nt" and platform_version == "1"') == False
+    assert complex_marker('os_name == "posix" or platform_version == "1"') == True
+
+
+def test_flat_marker_nested_groups():
+    # Nested lists that are always false drop their clause, including output already written and separators
+    assert flat_marker('platform_machine == "x86-64" and (os_name == "nt" or sys_platform == "win32") '
+                       'and platform_release > "3.4"') == False
+    assert flat_marker('platform_machine == "x86-64" and (os_name == "nt") and platform_release > "3.4" '
+                       'or python_version < "3.4"') == 'with python(abi) < 3.4'
+    assert flat_marker('python_version < "3.4" or platform_machine == "x86-64" and (os_name == "nt") '
+                       'and platform_release > "3.4"') == 'with python(abi) < 3.4'
+    # Nested lists that are always true are dropped from their clause, or make the whole list true
+    assert flat_marker('platform_machine == "x86-64" and (os_name == "posix" or platform_release > "3.4") '
+                       'and python_version < "3.4"') == 'with python(x86-64) with python(abi) < 3.4'
+    assert flat_marker('platform_machine == "x86-64" or (os_name == "posix" and sys_platform == "linux")') == True
+
+
+def test_flat_marker_parentheses():
+    # The placeholder becomes a parenthesis only if several clauses remain
+    assert flat_marker('platform_machine == "x86-64" and (platform_release > "3.4" or python_version < "3.4") '
+                       'and os_name == "posix"') == 'with python(x86-64) (with kernel > 3.4 or with python(abi) < 3.4)'
+    assert flat_marker('platform_machine == "x86-64" and (os_name == "nt" or platform_release > "3.4")') == \
+            'with python(x86-64) with kernel > 3.4'
+    assert flat_marker('platform_machine == "x86-64" or os_name == "nt" or platform_release > "3.4"') == \
+            '(with python(x86-64) or with kernel > 3.4)'
+    assert flat_marker('(platform_machine == "x86-64" or platform_release > "3.4") or python_version < "3.4"') == \
+            '((with python(x86-64) or with kernel > 3.4) or with python(abi) < 3.4)'
+
+    results = {}
+    flat_marker('(platform_machine == "x86-64" or platform_release > "3.4") and os_name == "posix"', results)
+    assert sorted(map(str, results.values())) == ['(with python(x86-64) or with kernel > 3.4)'] * 2
+
+
+def test_marker_memo():
+    memo = MarkerMemo()
+    text = '(platform_machine == "x86-64" or os_name == "nt") and (platform_machine == "x86-64" or os_name == "nt")'
+    templates = {**TEMPLATES, 'python_arch': 'python-memo({arch})'}
+    conversions = build_marker_converter(templates).cache_info
+    results = []
+    for extras in [[], ['micro'], []]:
+        results.append(simplify_marker_to_rpm_condition(Marker(text), {**ENVIRONMENT, 'extra': extras}, templates,
+                                                        memo=memo))
+        assert results[-1] == 'with python-memo(x86-64) with python-memo(x86-64)'
+        assert simplify_marker_to_rpm_condition(Marker('extra == "micro" or os_name == "nt"'),
+                                                {**ENVIRONMENT, 'extra': extras}, templates, memo=memo) == bool(extras)
+    # Identical sub-markers are simplified once per environments, repeated markers are returned from the memo
+    assert conversions().hits + conversions().misses == 2
+    assert results[2] is results[0] and results[1] is not results[0]
 
 
 def test_version_comparison():